@@ -2,166 +2,304 @@
 """
 Flask Web Dashboard for Mouse Trap Monitoring System
 Real-time web interface with SocketIO for live updates
+
+Production: gunicorn -k geventwebsocket.gunicorn.workers.GeventWebSocketWorker \
+                     -w 1 --bind 0.0.0.0:5000 dashboard:app
 """
 
+# Patch blocking I/O before anything else imports socket/threading
+from gevent import monkey
+monkey.patch_all()
+
 from flask import Flask, render_template, jsonify, request
+from flask.json.provider import JSONProvider
 from flask_socketio import SocketIO, emit
+from flask_compress import Compress
 import sqlite3
 from datetime import datetime, timedelta
-import json
+import orjson
 import logging
+import queue
+import time
+import atexit
+from contextlib import contextmanager
 import paho.mqtt.client as mqtt
-from threading import Thread
+from mqtt_utils import set_low_latency
+from cachetools import TTLCache, cached
+from threading import Thread, Lock, RLock
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+class OrjsonModule:
+    """json-module shim so SocketIO packets are encoded with orjson"""
+    
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = 'your-secret-key-here-change-this'
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, async_mode='gevent', cors_allowed_origins="*", json=OrjsonModule)
+# flask-compress suffixes the ETag with the encoding (e.g. "<hash>:gzip") and
+# answers If-None-Match itself after compressing
+app.config['COMPRESS_EVALUATE_CONDITIONAL_REQUEST'] = True
+Compress(app)
 
 # Configuration
 DATABASE_PATH = "/var/lib/trap-monitor/trap_events.db"
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
+MQTT_TOPIC = "trap-monitor/events"  # Event batches re-published by mqtt_logger after commit
+MQTT_CLIENT_ID = "dashboard-live"  # Stable ID so the broker keeps our session (one instance only)
+DB_POOL_SIZE = 4
+QUERY_CACHE_TTL = 5  # seconds
+LIVE_BATCH_WINDOW = 0.05  # seconds to coalesce live events
+LIVE_BATCH_MAX = 64  # flush immediately once this many events are pending
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# SQLite connection pool (shared for the process lifetime)
+_pool = queue.Queue(maxsize=DB_POOL_SIZE)
+_pool_connections = []
+_pool_lock = Lock()
+
+def _open_connection():
+    """Open a pooled SQLite connection with read-friendly PRAGMAs"""
+    conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA cache_size=-20000')
+    return conn
+
+def _fill_pool():
+    """Lazily create the pooled connections on first use"""
+    with _pool_lock:
+        if _pool_connections:
+            return
+        for _ in range(DB_POOL_SIZE):
+            conn = _open_connection()
+            _pool_connections.append(conn)
+            _pool.put(conn)
+
+@contextmanager
+def get_conn():
+    """Borrow a connection from the pool and return it when done"""
+    if not _pool_connections:
+        _fill_pool()
+    conn = _pool.get()
+    try:
+        yield conn
+    finally:
+        _pool.put(conn)
+
+@atexit.register
+def _close_pool():
+    """Close all pooled connections on shutdown"""
+    with _pool_lock:
+        for conn in _pool_connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        _pool_connections.clear()
+
+# TTL caches for read endpoints (cleared on every live MQTT event)
+_cache_lock = RLock()
+_nodes_cache = TTLCache(maxsize=64, ttl=QUERY_CACHE_TTL)
+_events_cache = TTLCache(maxsize=64, ttl=QUERY_CACHE_TTL)
+_stats_cache = TTLCache(maxsize=64, ttl=QUERY_CACHE_TTL)
+_battery_cache = TTLCache(maxsize=64, ttl=QUERY_CACHE_TTL)
+
+def invalidate_query_cache():
+    """Drop all cached query results so the next request hits the database"""
+    with _cache_lock:
+        for cache in (_nodes_cache, _events_cache, _stats_cache, _battery_cache):
+            cache.clear()
+
+# Read queries and the column names used to build result dicts
+_COLS_NODES = ('node_id', 'mac_address', 'last_seen', 'last_event_type',
+               'total_triggers', 'battery_voltage', 'is_online')
+_SQL_ALL_NODES = '''
+    SELECT node_id, mac_address, last_seen, last_event_type,
+           total_triggers, battery_voltage, is_online
+    FROM node_status
+    ORDER BY node_id
+'''
+
+_COLS_EVENTS = ('id', 'node_id', 'event_type', 'event_type_str', 'trap_count',
+                'battery_voltage', 'route_hops', 'received_at')
+_SQL_RECENT_EVENTS = '''
+    SELECT id, node_id, event_type, event_type_str, trap_count,
+           battery_voltage, route_hops, received_at
+    FROM trap_events
+    WHERE id > ?
+    ORDER BY id DESC
+    LIMIT ?
+'''
+
+_COLS_NODE_EVENTS = ('id', 'node_id', 'event_type', 'event_type_str', 'trap_count',
+                     'battery_voltage', 'received_at')
+_SQL_NODE_EVENTS = '''
+    SELECT id, node_id, event_type, event_type_str, trap_count,
+           battery_voltage, received_at
+    FROM trap_events
+    WHERE node_id = ? AND id > ?
+    ORDER BY id DESC
+    LIMIT ?
+'''
+
+# Daily trigger counts, total triggers, active nodes and
+# triggers in the last 24 hours in a single round-trip
+_SQL_STATISTICS = '''
+    WITH d AS (
+        SELECT date, total_triggers
+        FROM statistics
+        WHERE date >= date('now', '-' || ? || ' days')
+          AND date >= COALESCE(?, '')
+        ORDER BY date
+    )
+    SELECT
+        (SELECT json_group_array(json_object('date', date,
+                                             'total_triggers', total_triggers))
+         FROM d) AS daily,
+        (SELECT SUM(total_triggers) FROM statistics) AS total,
+        (SELECT COUNT(*) FROM node_status WHERE is_online = 1) AS active_nodes,
+        (SELECT COUNT(*) FROM trap_events
+         WHERE event_type = 1 AND received_at >= datetime('now', '-1 day')) AS last_24h
+'''
+
+_COLS_BATTERY = ('node_id', 'battery_voltage', 'last_seen')
+_SQL_BATTERY = '''
+    SELECT node_id, battery_voltage, last_seen
+    FROM node_status
+    ORDER BY battery_voltage ASC
+'''
+
 class DatabaseHandler:
     """Handle database queries"""
     
     @staticmethod
-    def get_connection():
-        conn = sqlite3.connect(DATABASE_PATH)
-        conn.row_factory = sqlite3.Row
-        return conn
-    
-    @staticmethod
+    @cached(_nodes_cache, lock=_cache_lock)
     def get_all_nodes():
         """Get all node status information"""
-        conn = DatabaseHandler.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT node_id, mac_address, last_seen, last_event_type,
-                   total_triggers, battery_voltage, is_online
-            FROM node_status
-            ORDER BY node_id
-        ''')
-        nodes = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return nodes
+        with get_conn() as conn:
+            rows = conn.execute(_SQL_ALL_NODES).fetchall()
+        return [dict(zip(_COLS_NODES, row)) for row in rows]
     
     @staticmethod
-    def get_recent_events(limit=50):
-        """Get recent trap events"""
-        conn = DatabaseHandler.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, node_id, event_type, event_type_str, trap_count,
-                   battery_voltage, route_hops, received_at
-            FROM trap_events
-            ORDER BY received_at DESC
-            LIMIT ?
-        ''', (limit,))
-        events = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return events
+    @cached(_events_cache, lock=_cache_lock)
+    def get_recent_events(limit=50, since_id=0):
+        """Get recent trap events (only those newer than since_id)"""
+        with get_conn() as conn:
+            rows = conn.execute(_SQL_RECENT_EVENTS, (since_id, limit)).fetchall()
+        return [dict(zip(_COLS_EVENTS, row)) for row in rows]
     
     @staticmethod
-    def get_node_events(node_id, limit=20):
-        """Get events for specific node"""
-        conn = DatabaseHandler.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, node_id, event_type, event_type_str, trap_count,
-                   battery_voltage, received_at
-            FROM trap_events
-            WHERE node_id = ?
-            ORDER BY received_at DESC
-            LIMIT ?
-        ''', (node_id, limit))
-        events = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return events
+    def get_node_events(node_id, limit=20, since_id=0):
+        """Get events for specific node (only those newer than since_id)"""
+        with get_conn() as conn:
+            rows = conn.execute(_SQL_NODE_EVENTS, (node_id, since_id, limit)).fetchall()
+        return [dict(zip(_COLS_NODE_EVENTS, row)) for row in rows]
     
     @staticmethod
-    def get_statistics(days=7):
-        """Get statistics for the past N days"""
-        conn = DatabaseHandler.get_connection()
-        cursor = conn.cursor()
-        
-        # Daily trigger counts
-        cursor.execute('''
-            SELECT date, total_triggers
-            FROM statistics
-            WHERE date >= date('now', '-' || ? || ' days')
-            ORDER BY date
-        ''', (days,))
-        daily_stats = [dict(row) for row in cursor.fetchall()]
-        
-        # Total triggers
-        cursor.execute('SELECT SUM(total_triggers) as total FROM statistics')
-        total = cursor.fetchone()['total'] or 0
-        
-        # Active nodes
-        cursor.execute('SELECT COUNT(*) as count FROM node_status WHERE is_online = 1')
-        active_nodes = cursor.fetchone()['count']
-        
-        # Triggers in last 24 hours
-        cursor.execute('''
-            SELECT COUNT(*) as count FROM trap_events
-            WHERE event_type = 1 AND received_at >= datetime('now', '-1 day')
-        ''')
-        last_24h = cursor.fetchone()['count']
-        
-        conn.close()
+    @cached(_stats_cache, lock=_cache_lock)
+    def get_statistics(days=7, since_date=None):
+        """Get statistics for the past N days (daily rows from since_date onwards)"""
+        with get_conn() as conn:
+            daily, total, active_nodes, last_24h = conn.execute(
+                _SQL_STATISTICS, (days, since_date)
+            ).fetchone()
         
         return {
-            'daily': daily_stats,
-            'total_triggers': total,
+            'daily': orjson.loads(daily),
+            'total_triggers': total or 0,
             'active_nodes': active_nodes,
             'triggers_24h': last_24h
         }
     
     @staticmethod
+    @cached(_battery_cache, lock=_cache_lock)
     def get_battery_status():
         """Get battery status for all nodes"""
-        conn = DatabaseHandler.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT node_id, battery_voltage, last_seen
-            FROM node_status
-            ORDER BY battery_voltage ASC
-        ''')
-        batteries = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return batteries
+        with get_conn() as conn:
+            rows = conn.execute(_SQL_BATTERY).fetchall()
+        return [dict(zip(_COLS_BATTERY, row)) for row in rows]
+
+# Live events handed from the MQTT thread to the SocketIO loop
+live_events = queue.SimpleQueue()
+
+def pump_live_events():
+    """Forward queued live events to all connected WebSocket clients in batches"""
+    while True:
+        batch = [live_events.get()]
+        deadline = time.monotonic() + LIVE_BATCH_WINDOW
+        
+        while len(batch) < LIVE_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(live_events.get(timeout=remaining))
+            except queue.Empty:
+                break
+        
+        try:
+            socketio.emit('trap_events_batch', batch, namespace='/')
+        except Exception as e:
+            logger.error(f"Error forwarding live events: {e}")
 
 # MQTT Client for live updates
 class MQTTSubscriber:
-    """Subscribe to MQTT and forward to SocketIO"""
+    """Subscribe to committed events from mqtt_logger and forward to SocketIO"""
     
     def __init__(self):
-        self.client = mqtt.Client()
+        # Persistent session: the broker keeps our subscription across reconnects
+        self.client = mqtt.Client(client_id=MQTT_CLIENT_ID, clean_session=False, transport='tcp')
+        self.client.max_inflight_messages_set(200)
+        self.client.max_queued_messages_set(10000)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             logger.info("MQTT connected for live updates")
-            client.subscribe("trap/#")
+            set_low_latency(client)
+            if not flags.get('session present'):
+                client.subscribe(MQTT_TOPIC, qos=0)
     
     def on_message(self, client, userdata, msg):
         try:
-            payload = json.loads(msg.payload.decode())
-            # Forward to all connected WebSocket clients
-            socketio.emit('trap_event', payload, namespace='/')
-            logger.info(f"Live event forwarded: Node {payload.get('node_id')}")
+            events = orjson.loads(msg.payload)
+            invalidate_query_cache()
+            # Hand off to the SocketIO loop for broadcasting
+            for payload in events:
+                live_events.put(payload)
+            logger.debug("Live events forwarded: %d", len(events))
         except Exception as e:
             logger.error(f"Error processing MQTT message: {e}")
     
     def start(self):
         try:
-            self.client.connect(MQTT_BROKER, MQTT_PORT, 60)
+            # Connect from the network loop so the reconnect backoff also
+            # covers a broker that is down when the dashboard starts
+            self.client.connect_async(MQTT_BROKER, MQTT_PORT, 60)
             self.client.loop_start()
             logger.info("MQTT subscriber started")
         except Exception as e:
@@ -170,9 +308,22 @@ class MQTTSubscriber:
 # Start MQTT subscriber in background
 mqtt_subscriber = MQTTSubscriber()
 mqtt_subscriber.start()
+socketio.start_background_task(pump_live_events)
 
 # ==================== WEB ROUTES ====================
 
+@app.after_request
+def add_cache_headers(response):
+    """Let browsers reuse API responses for as long as the server-side cache"""
+    # Registered after Compress, so this runs first; flask-compress then
+    # rewrites the ETag for the chosen encoding and handles If-None-Match
+    if request.path.startswith('/api/') and response.status_code == 200:
+        response.headers['Cache-Control'] = (
+            f"public, max-age={QUERY_CACHE_TTL}, stale-while-revalidate={QUERY_CACHE_TTL * 6}"
+        )
+        response.add_etag()
+    return response
+
 @app.route('/')
 def index():
     """Main dashboard page"""
@@ -193,7 +344,8 @@ def api_events():
     """Get recent events"""
     try:
         limit = request.args.get('limit', 50, type=int)
-        events = DatabaseHandler.get_recent_events(limit)
+        since_id = request.args.get('since_id', 0, type=int)
+        events = DatabaseHandler.get_recent_events(limit, since_id)
         return jsonify({'success': True, 'events': events})
     except Exception as e:
         logger.error(f"Error getting events: {e}")
@@ -204,7 +356,8 @@ def api_node_events(node_id):
     """Get events for specific node"""
     try:
         limit = request.args.get('limit', 20, type=int)
-        events = DatabaseHandler.get_node_events(node_id, limit)
+        since_id = request.args.get('since_id', 0, type=int)
+        events = DatabaseHandler.get_node_events(node_id, limit, since_id)
         return jsonify({'success': True, 'events': events})
     except Exception as e:
         logger.error(f"Error getting node events: {e}")
@@ -233,6 +386,9 @@ def api_battery():
 
 # ==================== SOCKETIO EVENTS ====================
 
+# Node state last sent to each client, keyed by SocketIO session id
+client_nodes = {}
+
 @socketio.on('connect')
 def handle_connect():
     """Handle client connection"""
@@ -242,18 +398,33 @@ def handle_connect():
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle client disconnection"""
+    client_nodes.pop(request.sid, None)
     logger.info('Client disconnected')
 
 @socketio.on('request_update')
-def handle_update_request():
-    """Handle client request for data update"""
+def handle_update_request(data=None):
+    """Handle client request for data update
+    
+    With {since_id, since_stats_date} only new events, changed nodes and
+    daily statistics from since_stats_date are sent; otherwise everything.
+    """
     try:
+        data = data or {}
+        since_id = data.get('since_id')
+        delta = since_id is not None
+        
         nodes = DatabaseHandler.get_all_nodes()
-        events = DatabaseHandler.get_recent_events(20)
-        stats = DatabaseHandler.get_statistics(7)
+        events = DatabaseHandler.get_recent_events(20, since_id or 0)
+        stats = DatabaseHandler.get_statistics(7, data.get('since_stats_date') if delta else None)
+        
+        # Only send nodes whose state changed since this client's last update
+        sent = client_nodes.get(request.sid, {}) if delta else {}
+        changed = [node for node in nodes if sent.get(node['node_id']) != node]
+        client_nodes[request.sid] = {node['node_id']: node for node in nodes}
         
         emit('data_update', {
-            'nodes': nodes,
+            'delta': delta,
+            'nodes': changed,
             'events': events,
             'statistics': stats
         })
@@ -261,6 +432,7 @@ def handle_update_request():
         logger.error(f"Error handling update request: {e}")
 
 if __name__ == '__main__':
+    # Development server; production runs under gunicorn (see module docstring)
     logger.info("=== Flask Dashboard Starting ===")
     logger.info("Access dashboard at: http://localhost:5000")
     socketio.run(app, host='0.0.0.0', port=5000, debug=False)
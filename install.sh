@@ -78,7 +78,13 @@ pip install \
     flask-socketio \
     python-socketio \
     python-telegram-bot \
-    pyyaml
+    pyyaml \
+    cachetools \
+    orjson \
+    gevent \
+    gevent-websocket \
+    gunicorn \
+    flask-compress
 
 deactivate
 
@@ -87,6 +93,7 @@ echo "[6/8] Copying application files..."
 cp mqtt_logger.py /opt/trap-monitor/
 cp telegram_notifier.py /opt/trap-monitor/
 cp dashboard.py /opt/trap-monitor/
+cp mqtt_utils.py /opt/trap-monitor/
 chmod +x /opt/trap-monitor/*.py
 
 # Copy configuration
@@ -146,14 +153,15 @@ EOF
 cat > /etc/systemd/system/trap-dashboard.service << 'EOF'
 [Unit]
 Description=Mouse Trap Web Dashboard
-After=network.target
+After=mosquitto.service network.target
+Wants=mosquitto.service
 
 [Service]
 Type=simple
 User=trapmonitor
 Group=trapmonitor
 WorkingDirectory=/opt/trap-monitor
-ExecStart=/opt/trap-monitor/venv/bin/python3 /opt/trap-monitor/dashboard.py
+ExecStart=/opt/trap-monitor/venv/bin/gunicorn -k geventwebsocket.gunicorn.workers.GeventWebSocketWorker -w 1 --bind 0.0.0.0:5000 dashboard:app
 Restart=always
 RestartSec=10
 StandardOutput=append:/var/log/trap-monitor/dashboard.log
@@ -5,25 +5,82 @@ Subscribes to MQTT topics and logs events to SQLite database
 """
 
 import paho.mqtt.client as mqtt
-import json
+from mqtt_utils import set_low_latency
+import orjson
 import sqlite3
 from datetime import datetime
 import logging
 import sys
 import signal
+import queue
+import atexit
+import threading
 
 # Configuration
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
 MQTT_TOPIC = "trap/#"
+BROADCAST_TOPIC = "trap-monitor/events"  # Committed event batches (outside trap/#)
 DATABASE_PATH = "/var/lib/trap-monitor/trap_events.db"
 
-# Setup logging
+# Write batching
+WRITE_BATCH_SIZE = 256       # Max events committed per transaction
+WRITE_QUEUE_SIZE = 10000     # Max events buffered before producers block
+WRITE_FLUSH_INTERVAL = 0.05  # Seconds to wait for new events when idle
+
+# Summary of message traffic logged at INFO instead of every message
+STATS_LOG_INTERVAL = 60  # Seconds
+
+# Optional payload fields bound into SQL (must be scalars)
+EVENT_FIELDS = ('event_type_str', 'trap_count', 'battery_voltage', 'route_hops',
+                'timestamp', 'gateway_time', 'mac_address')
+
+# SQL statements (kept constant so sqlite3 reuses its prepared statements)
+_SQL_INSERT_EVENT = '''
+    INSERT OR IGNORE INTO trap_events 
+    (node_id, event_type, event_type_str, trap_count, battery_voltage, 
+     route_hops, timestamp, gateway_time, mac_address)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+_SQL_UPSERT_NODE = '''
+    INSERT INTO node_status 
+    (node_id, mac_address, last_seen, last_event_type, 
+     total_triggers, battery_voltage, is_online)
+    VALUES (?, ?, CURRENT_TIMESTAMP, ?, ?, ?, 1)
+    ON CONFLICT(node_id) DO UPDATE SET
+        mac_address = excluded.mac_address,
+        last_seen = CURRENT_TIMESTAMP,
+        last_event_type = excluded.last_event_type,
+        total_triggers = total_triggers + excluded.total_triggers,
+        battery_voltage = excluded.battery_voltage,
+        is_online = 1
+'''
+
+_SQL_UPSERT_STATS = '''
+    INSERT INTO statistics (date, total_triggers, active_nodes)
+    VALUES (?, 1, 1)
+    ON CONFLICT(date) DO UPDATE SET
+        total_triggers = total_triggers + 1
+'''
+
+# Rows inserted by the current batch (ids are AUTOINCREMENT, so id > previous max)
+_SQL_LAST_EVENT_ID = 'SELECT COALESCE(MAX(id), 0) FROM trap_events'
+_COLS_PUBLISHED = ('id', 'node_id', 'event_type', 'event_type_str', 'trap_count',
+                   'battery_voltage', 'route_hops', 'received_at')
+_SQL_EVENTS_AFTER = '''
+    SELECT id, node_id, event_type, event_type_str, trap_count,
+           battery_voltage, route_hops, received_at
+    FROM trap_events
+    WHERE id > ?
+    ORDER BY id
+'''
+
+# Setup logging (systemd appends stdout to /var/log/trap-monitor/mqtt-logger.log)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler('/var/log/trap-monitor/mqtt-logger.log'),
         logging.StreamHandler(sys.stdout)
     ]
 )
@@ -32,9 +89,24 @@ logger = logging.getLogger(__name__)
 class TrapDatabase:
     """Handle database operations for trap events"""
     
-    def __init__(self, db_path):
+    def __init__(self, db_path, on_commit=None):
         self.db_path = db_path
+        self.on_commit = on_commit  # Called with the inserted rows (with ids) after each commit
         self.init_database()
+        
+        # Persistent connection owned by the writer thread
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA mmap_size=268435456')
+        self.conn.execute('PRAGMA cache_size=-40000')
+        self.conn.execute('PRAGMA busy_timeout=5000')
+        
+        # Events are buffered and committed in batches by a background thread
+        self.queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self._stopping = threading.Event()
+        self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
     
     def init_database(self):
         """Initialize database schema"""
@@ -42,6 +114,12 @@ class TrapDatabase:
             conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
             
+            # WAL lets the dashboard read while the logger writes;
+            # journal_mode persists in the database file
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute('PRAGMA wal_autocheckpoint=1000')
+            
             # Events table
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS trap_events (
@@ -85,20 +163,21 @@ class TrapDatabase:
             ''')
             
             # Create indexes for better query performance
+            # (rowid is implicit, so this also covers node_id = ? AND id > ?)
             cursor.execute('''
                 CREATE INDEX IF NOT EXISTS idx_events_node_id 
                 ON trap_events(node_id)
             ''')
             
+            # Covers the 24h trigger count
             cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_events_timestamp 
-                ON trap_events(received_at)
+                CREATE INDEX IF NOT EXISTS idx_events_type_time 
+                ON trap_events(event_type, received_at)
             ''')
             
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_events_type 
-                ON trap_events(event_type)
-            ''')
+            # Superseded by idx_events_type_time / no longer queried
+            cursor.execute('DROP INDEX IF EXISTS idx_events_type')
+            cursor.execute('DROP INDEX IF EXISTS idx_events_timestamp')
             
             conn.commit()
             conn.close()
@@ -109,20 +188,58 @@ class TrapDatabase:
             raise
     
     def insert_event(self, data):
-        """Insert trap event into database"""
+        """Queue trap event for the next batched database write"""
+        # Drop malformed messages before they reach SQL
+        if not isinstance(data, dict):
+            logger.warning(f"Ignoring non-object payload: {data!r}")
+            return False
+        node_id = data.get('node_id')
+        event_type = data.get('event_type')
+        if type(node_id) is not int or type(event_type) is not int:
+            logger.warning(f"Ignoring event with invalid node_id/event_type: {node_id!r}/{event_type!r}")
+            return False
+        for field in EVENT_FIELDS:
+            value = data.get(field)
+            if value is not None and not isinstance(value, (int, float, str)):
+                logger.warning(f"Ignoring event with invalid {field}: {value!r}")
+                return False
+        
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            self.queue.put(data)
+            return True
+        except Exception as e:
+            logger.error(f"Database queue error: {e}")
+            return False
+    
+    def _writer_loop(self):
+        """Drain queued events and commit them in batches"""
+        while not (self._stopping.is_set() and self.queue.empty()):
+            try:
+                batch = [self.queue.get(timeout=WRITE_FLUSH_INTERVAL)]
+            except queue.Empty:
+                continue
             
-            # Insert event
-            cursor.execute('''
-                INSERT OR IGNORE INTO trap_events 
-                (node_id, event_type, event_type_str, trap_count, battery_voltage, 
-                 route_hops, timestamp, gateway_time, mac_address)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                data.get('node_id'),
-                data.get('event_type'),
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            # Keep the writer alive whatever happens to one batch
+            try:
+                self.write_batch(batch)
+            except Exception as e:
+                logger.error(f"Database writer error, dropped {len(batch)} events: {e}")
+    
+    def write_batch(self, batch):
+        """Insert a batch of trap events in a single transaction"""
+        today = datetime.now().date()
+        rows = []
+        for data in batch:
+            event_type = data['event_type']
+            event = (
+                data['node_id'],
+                event_type,
                 data.get('event_type_str'),
                 data.get('trap_count'),
                 data.get('battery_voltage'),
@@ -130,59 +247,117 @@ class TrapDatabase:
                 data.get('timestamp'),
                 data.get('gateway_time'),
                 data.get('mac_address')
-            ))
-            
-            # Update node status
-            cursor.execute('''
-                INSERT OR REPLACE INTO node_status 
-                (node_id, mac_address, last_seen, last_event_type, 
-                 total_triggers, battery_voltage, is_online)
-                VALUES (?, ?, CURRENT_TIMESTAMP, ?, 
-                        COALESCE((SELECT total_triggers FROM node_status WHERE node_id = ?), 0) + ?,
-                        ?, 1)
-            ''', (
-                data.get('node_id'),
+            )
+            status = (
+                data['node_id'],
                 data.get('mac_address'),
                 data.get('event_type_str'),
-                data.get('node_id'),
-                1 if data.get('event_type') == 1 else 0,  # Increment only for trigger events
+                1 if event_type == 1 else 0,  # Increment only for trigger events
                 data.get('battery_voltage')
-            ))
-            
+            )
             # Update daily statistics for trigger events
-            if data.get('event_type') == 1:
-                today = datetime.now().date()
-                cursor.execute('''
-                    INSERT INTO statistics (date, total_triggers, active_nodes)
-                    VALUES (?, 1, 1)
-                    ON CONFLICT(date) DO UPDATE SET
-                        total_triggers = total_triggers + 1
-                ''', (today,))
+            trigger = (today,) if event_type == 1 else None
+            rows.append((event, status, trigger))
+        
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute('BEGIN')
+            last_id = cursor.execute(_SQL_LAST_EVENT_ID).fetchone()[0]
+            cursor.execute('SAVEPOINT batch')
+            try:
+                self._write_rows(cursor, rows)
+                cursor.execute('RELEASE batch')
+            except Exception as e:
+                # Retry row by row so a bad event only loses itself
+                cursor.execute('ROLLBACK TO batch')
+                cursor.execute('RELEASE batch')
+                logger.warning(f"Batch insert failed ({e}), retrying {len(batch)} events individually")
+                for data, row in zip(batch, rows):
+                    cursor.execute('SAVEPOINT event')
+                    try:
+                        self._write_rows(cursor, [row])
+                        cursor.execute('RELEASE event')
+                    except Exception as e:
+                        cursor.execute('ROLLBACK TO event')
+                        cursor.execute('RELEASE event')
+                        logger.error(f"Dropping event {data!r}: {e}")
             
-            conn.commit()
-            conn.close()
+            # Only rows that were actually inserted (not ignored duplicates)
+            inserted = [dict(zip(_COLS_PUBLISHED, row))
+                        for row in cursor.execute(_SQL_EVENTS_AFTER, (last_id,))]
             
-            logger.info(f"Event logged: Node {data.get('node_id')}, Type: {data.get('event_type_str')}")
-            return True
+            self.conn.commit()
+            
+            logger.debug("Events logged: %d of %d in batch", len(inserted), len(batch))
             
         except Exception as e:
+            self.conn.rollback()
             logger.error(f"Database insert error: {e}")
             return False
+        
+        if self.on_commit and inserted:
+            try:
+                self.on_commit(inserted)
+            except Exception as e:
+                logger.error(f"Error publishing committed events: {e}")
+        return True
+    
+    def _write_rows(self, cursor, rows):
+        """Execute the event, node status and statistics writes for prepared rows"""
+        # Insert events
+        cursor.executemany(_SQL_INSERT_EVENT, [event for event, _, _ in rows])
+        
+        # Update node status
+        cursor.executemany(_SQL_UPSERT_NODE, [status for _, status, _ in rows])
+        
+        # Update daily statistics
+        triggers = [trigger for _, _, trigger in rows if trigger]
+        if triggers:
+            cursor.executemany(_SQL_UPSERT_STATS, triggers)
+    
+    def close(self):
+        """Flush pending events and close the database connection"""
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        self._writer.join()
+        self.conn.close()
 
 class MQTTLogger:
     """MQTT client for receiving and logging trap events"""
     
     def __init__(self):
-        self.db = TrapDatabase(DATABASE_PATH)
+        self.db = TrapDatabase(DATABASE_PATH, on_commit=self.publish_batch)
         self.client = mqtt.Client()
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
         
+        # Message counter for the periodic summary
+        self.message_count = 0
+        self.count_lock = threading.Lock()
+        self.stats_timer = None
+        
+    def log_stats(self):
+        """Log how many messages arrived since the last summary"""
+        with self.count_lock:
+            count, self.message_count = self.message_count, 0
+        if count:
+            logger.info("%d events in last %ds", count, STATS_LOG_INTERVAL)
+        
+        self.stats_timer = threading.Timer(STATS_LOG_INTERVAL, self.log_stats)
+        self.stats_timer.daemon = True
+        self.stats_timer.start()
+    
+    def publish_batch(self, batch):
+        """Re-publish committed events for the dashboard's live updates"""
+        self.client.publish(BROADCAST_TOPIC, orjson.dumps(batch))
+    
     def on_connect(self, client, userdata, flags, rc):
         """Callback for when client connects to broker"""
         if rc == 0:
             logger.info("Connected to MQTT broker")
+            set_low_latency(client)
             client.subscribe(MQTT_TOPIC)
             logger.info(f"Subscribed to topic: {MQTT_TOPIC}")
         else:
@@ -197,25 +372,30 @@ class MQTTLogger:
         """Callback for when a message is received"""
         try:
             # Parse JSON payload
-            payload = json.loads(msg.payload.decode())
+            payload = orjson.loads(msg.payload)
             
-            logger.info(f"Received message on {msg.topic}")
-            logger.debug(f"Payload: {payload}")
+            with self.count_lock:
+                self.message_count += 1
+            
+            logger.debug("Received message on %s: %s", msg.topic, payload)
             
             # Log to database
-            self.db.insert_event(payload)
+            if not self.db.insert_event(payload):
+                return
+            
+            event_type = payload['event_type']
             
             # Special handling for trigger events
-            if payload.get('event_type') == 1:
+            if event_type == 1:
                 logger.warning(f"🪤 TRAP TRIGGERED! Node {payload.get('node_id')}, "
                              f"Count: {payload.get('trap_count')}")
             
             # Low battery warnings
-            if payload.get('event_type') == 2:
+            elif event_type == 2:
                 logger.warning(f"🔋 LOW BATTERY! Node {payload.get('node_id')}, "
                              f"Voltage: {payload.get('battery_voltage')}V")
             
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"Invalid JSON in message: {e}")
         except Exception as e:
             logger.error(f"Error processing message: {e}")
@@ -224,6 +404,7 @@ class MQTTLogger:
         """Start the MQTT client"""
         try:
             logger.info("Starting MQTT Logger...")
+            self.log_stats()
             self.client.connect(MQTT_BROKER, MQTT_PORT, 60)
             self.client.loop_forever()
         except KeyboardInterrupt:
@@ -236,8 +417,11 @@ class MQTTLogger:
     def stop(self):
         """Stop the MQTT client"""
         logger.info("Stopping MQTT Logger...")
+        if self.stats_timer:
+            self.stats_timer.cancel()
         self.client.disconnect()
         self.client.loop_stop()
+        self.db.close()
 
 def signal_handler(sig, frame):
     """Handle shutdown signals"""
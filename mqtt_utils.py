@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+"""
+Shared MQTT helpers for Mouse Trap Monitoring System services
+"""
+
+import socket
+import logging
+
+logger = logging.getLogger(__name__)
+
+def set_low_latency(client):
+    """Disable Nagle on a connected paho client's socket"""
+    sock = client.socket()
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError as e:
+        logger.warning(f"Could not set MQTT socket options: {e}")
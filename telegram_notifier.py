@@ -5,25 +5,60 @@ Sends instant notifications via Telegram when traps are triggered
 """
 
 import paho.mqtt.client as mqtt
-import json
+from mqtt_utils import set_low_latency
+import orjson
 import yaml
 import logging
 import sys
 import signal
+import time
+from collections import OrderedDict
 from datetime import datetime
 import asyncio
+import threading
 from telegram import Bot
-from telegram.error import TelegramError
+from telegram.error import TelegramError, RetryAfter
 
 # Configuration file
 CONFIG_FILE = "/etc/trap-monitor/config.yaml"
 
-# Setup logging
+# Message templates
+TRAP_TEMPLATE = (
+    "🪤 **MOUSE TRAP TRIGGERED!**\n\n"
+    "📍 Location: {location}\n"
+    "🔢 Node ID: {node_id}\n"
+    "📊 Total Catches: {trap_count}\n"
+    "🔋 Battery: {battery:.2f}V\n"
+    "🕐 Time: {timestamp}"
+)
+
+LOW_BATTERY_TEMPLATE = (
+    "🔋 **LOW BATTERY WARNING**\n\n"
+    "📍 Location: {location}\n"
+    "🔢 Node ID: {node_id}\n"
+    "⚡ Voltage: {battery:.2f}V\n"
+    "⚠️ Please replace battery soon"
+)
+
+STATUS_TEMPLATE = (
+    "ℹ️ **Status Update**\n\n"
+    "📍 {location}\n"
+    "🔋 {battery:.2f}V | "
+    "📊 {trap_count} catches"
+)
+
+# Outgoing message batching
+NOTIFY_BATCH_WINDOW = 0.2   # Seconds to collect notifications before sending
+MAX_MESSAGE_LENGTH = 4096   # Telegram message size limit
+
+# Rate limiter bookkeeping
+MAX_RATE_LIMIT_KEYS = 1024  # Most (node, event type) pairs remembered
+
+# Setup logging (stdout only; the systemd unit writes it to telegram-notifier.log)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler('/var/log/trap-monitor/telegram-notifier.log'),
         logging.StreamHandler(sys.stdout)
     ]
 )
@@ -34,7 +69,16 @@ class TelegramNotifier:
     
     def __init__(self, config):
         self.config = config
-        self.bot = Bot(token=config['telegram']['bot_token'])
+        
+        # Persistent event loop so the bot's HTTP session is reused
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self._run_loop, name="telegram-loop", daemon=True)
+        self.loop_thread.start()
+        self.bot = asyncio.run_coroutine_threadsafe(
+            self._create_bot(config['telegram']['bot_token']), self.loop
+        ).result()
+        asyncio.run_coroutine_threadsafe(self._start_sender(), self.loop).result()
+        
         self.chat_id = config['telegram']['chat_id']
         self.mqtt_broker = config['mqtt']['broker']
         self.mqtt_port = config['mqtt']['port']
@@ -44,8 +88,16 @@ class TelegramNotifier:
         self.notify_on_low_battery = config['notifications'].get('on_low_battery', True)
         self.notify_on_status = config['notifications'].get('on_status', False)
         
+        # Node location mapping (config keys are strings, MQTT node IDs are ints)
+        self.locations = {}
+        for key, location in (config.get('node_locations') or {}).items():
+            try:
+                self.locations[int(key)] = location
+            except (TypeError, ValueError):
+                self.locations[key] = location
+        
         # Rate limiting (prevent spam)
-        self.last_notification_time = {}
+        self.last_notification_time = OrderedDict()  # Oldest first
         self.min_notification_interval = config['notifications'].get('min_interval_seconds', 10)
         
         # Setup MQTT client
@@ -54,15 +106,93 @@ class TelegramNotifier:
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
         
+    def _run_loop(self):
+        """Run the notifier event loop in its own thread"""
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+    
+    async def _create_bot(self, token):
+        """Create the bot inside the notifier loop so its connection pool lives there"""
+        bot = Bot(token=token)
+        try:
+            await bot.initialize()
+        except TelegramError as e:
+            logger.error(f"Telegram bot initialization error: {e}")
+        return bot
+    
+    async def _start_sender(self):
+        """Create the outgoing queue and its consumer on the notifier loop"""
+        self.tx_queue = asyncio.Queue()
+        self.sender_task = asyncio.create_task(self._sender())
+    
+    def notify(self, kind, payload):
+        """Queue a notification from any thread ('text' payloads are sent as-is)"""
+        self.loop.call_soon_threadsafe(self.tx_queue.put_nowait, (kind, payload))
+    
+    async def _sender(self):
+        """Collect queued notifications and send them packed into as few messages as possible"""
+        while True:
+            items = [await self.tx_queue.get()]
+            await asyncio.sleep(NOTIFY_BATCH_WINDOW)
+            try:
+                while True:
+                    items.append(self.tx_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                pass
+            
+            try:
+                # Send each message separately so one failure doesn't drop the rest
+                for text in self.build_messages(items):
+                    try:
+                        await self.send_message(text)
+                    except Exception as e:
+                        logger.error(f"Error sending notification: {e}")
+            except Exception as e:
+                logger.error(f"Error building notifications: {e}")
+            finally:
+                for _ in items:
+                    self.tx_queue.task_done()
+    
+    def build_messages(self, items):
+        """Format queued notifications and pack them into messages"""
+        # should_notify already limits each (node, event type) to one
+        # notification per interval, so items are formatted one by one
+        formatters = {
+            'trigger': self.format_trap_message,
+            'low_battery': self.format_low_battery_message,
+            'status': self.format_status_message,
+        }
+        
+        parts = []
+        for kind, payload in items:
+            if kind == 'text':
+                parts.append(payload)
+                continue
+            # A payload that can't be formatted only skips itself
+            try:
+                parts.append(formatters[kind](payload))
+            except Exception as e:
+                logger.error(f"Error formatting {kind} notification for {payload!r}: {e}")
+        
+        # Combine into as few messages as Telegram's size limit allows
+        messages = []
+        for text in parts:
+            if messages and len(messages[-1]) + len(text) + 2 <= MAX_MESSAGE_LENGTH:
+                messages[-1] += "\n\n" + text
+            else:
+                messages.append(text)
+        return messages
+    
     def on_connect(self, client, userdata, flags, rc):
         """Callback for MQTT connection"""
         if rc == 0:
             logger.info("Connected to MQTT broker")
+            set_low_latency(client)
             client.subscribe("trap/#")
             logger.info("Subscribed to trap topics")
             
             # Send startup notification
-            asyncio.run(self.send_message("🟢 Trap Monitor System Online"))
+            self.notify('text', "🟢 Trap Monitor System Online")
         else:
             logger.error(f"Connection failed with code {rc}")
     
@@ -73,78 +203,81 @@ class TelegramNotifier:
     
     def should_notify(self, node_id, event_type):
         """Check if we should send notification (rate limiting)"""
-        key = f"{node_id}_{event_type}"
-        current_time = datetime.now().timestamp()
+        key = (node_id, event_type)
+        current_time = time.monotonic()
         
         if key in self.last_notification_time:
             time_since_last = current_time - self.last_notification_time[key]
             if time_since_last < self.min_notification_interval:
-                logger.debug(f"Rate limit: Skipping notification for {key}")
+                logger.debug("Rate limit: Skipping notification for %s", key)
                 return False
         
         self.last_notification_time[key] = current_time
+        self.last_notification_time.move_to_end(key)
+        
+        # Forget entries that can no longer rate limit anything
+        expiry = current_time - 10 * self.min_notification_interval
+        while self.last_notification_time:
+            oldest_key, oldest_time = next(iter(self.last_notification_time.items()))
+            if oldest_time >= expiry and len(self.last_notification_time) <= MAX_RATE_LIMIT_KEYS:
+                break
+            self.last_notification_time.popitem(last=False)
         return True
     
+    def get_location(self, node_id):
+        """Look up the configured location for a node"""
+        return self.locations.get(node_id, f"Node {node_id}")
+    
     def format_trap_message(self, data):
         """Format trap trigger message"""
         node_id = data.get('node_id', 'Unknown')
-        trap_count = data.get('trap_count', 0)
-        battery = data.get('battery_voltage', 0)
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        # Node location mapping (customize this)
-        locations = self.config.get('node_locations', {})
-        location = locations.get(str(node_id), f"Node {node_id}")
-        
-        message = f"🪤 **MOUSE TRAP TRIGGERED!**\n\n"
-        message += f"📍 Location: {location}\n"
-        message += f"🔢 Node ID: {node_id}\n"
-        message += f"📊 Total Catches: {trap_count}\n"
-        message += f"🔋 Battery: {battery:.2f}V\n"
-        message += f"🕐 Time: {timestamp}"
-        
-        return message
+        return TRAP_TEMPLATE.format(
+            location=self.get_location(node_id),
+            node_id=node_id,
+            trap_count=data.get('trap_count', 0),
+            battery=data.get('battery_voltage', 0),
+            timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        )
     
     def format_low_battery_message(self, data):
         """Format low battery warning message"""
         node_id = data.get('node_id', 'Unknown')
-        battery = data.get('battery_voltage', 0)
-        
-        locations = self.config.get('node_locations', {})
-        location = locations.get(str(node_id), f"Node {node_id}")
-        
-        message = f"🔋 **LOW BATTERY WARNING**\n\n"
-        message += f"📍 Location: {location}\n"
-        message += f"🔢 Node ID: {node_id}\n"
-        message += f"⚡ Voltage: {battery:.2f}V\n"
-        message += f"⚠️ Please replace battery soon"
-        
-        return message
+        return LOW_BATTERY_TEMPLATE.format(
+            location=self.get_location(node_id),
+            node_id=node_id,
+            battery=data.get('battery_voltage', 0)
+        )
     
     def format_status_message(self, data):
         """Format status update message"""
         node_id = data.get('node_id', 'Unknown')
-        battery = data.get('battery_voltage', 0)
-        trap_count = data.get('trap_count', 0)
-        
-        locations = self.config.get('node_locations', {})
-        location = locations.get(str(node_id), f"Node {node_id}")
-        
-        message = f"ℹ️ **Status Update**\n\n"
-        message += f"📍 {location}\n"
-        message += f"🔋 {battery:.2f}V | "
-        message += f"📊 {trap_count} catches"
-        
-        return message
+        return STATUS_TEMPLATE.format(
+            location=self.get_location(node_id),
+            battery=data.get('battery_voltage', 0),
+            trap_count=data.get('trap_count', 0)
+        )
     
     async def send_message(self, text):
         """Send message via Telegram"""
         try:
-            await self.bot.send_message(
-                chat_id=self.chat_id,
-                text=text,
-                parse_mode='Markdown'
-            )
+            try:
+                await self.bot.send_message(
+                    chat_id=self.chat_id,
+                    text=text,
+                    parse_mode='Markdown'
+                )
+            except RetryAfter as e:
+                # Flood control: wait as instructed, then retry once
+                delay = e.retry_after
+                if hasattr(delay, 'total_seconds'):
+                    delay = delay.total_seconds()
+                logger.warning(f"Telegram rate limit hit, retrying in {delay}s")
+                await asyncio.sleep(delay)
+                await self.bot.send_message(
+                    chat_id=self.chat_id,
+                    text=text,
+                    parse_mode='Markdown'
+                )
             logger.info("Telegram notification sent successfully")
             return True
         except TelegramError as e:
@@ -157,11 +290,11 @@ class TelegramNotifier:
     def on_message(self, client, userdata, msg):
         """Handle incoming MQTT messages"""
         try:
-            payload = json.loads(msg.payload.decode())
+            payload = orjson.loads(msg.payload)
             event_type = payload.get('event_type')
             node_id = payload.get('node_id')
             
-            logger.info(f"Received event: Type {event_type}, Node {node_id}")
+            logger.debug("Received event: type=%s node=%s", event_type, node_id)
             
             # Check rate limiting
             if not self.should_notify(node_id, event_type):
@@ -170,20 +303,17 @@ class TelegramNotifier:
             # Handle different event types
             if event_type == 1 and self.notify_on_trigger:
                 # Trap triggered
-                message = self.format_trap_message(payload)
-                asyncio.run(self.send_message(message))
+                self.notify('trigger', payload)
                 
             elif event_type == 2 and self.notify_on_low_battery:
                 # Low battery
-                message = self.format_low_battery_message(payload)
-                asyncio.run(self.send_message(message))
+                self.notify('low_battery', payload)
                 
             elif event_type == 0 and self.notify_on_status:
                 # Status update (usually disabled)
-                message = self.format_status_message(payload)
-                asyncio.run(self.send_message(message))
+                self.notify('status', payload)
             
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"Invalid JSON: {e}")
         except Exception as e:
             logger.error(f"Error processing message: {e}")
@@ -204,9 +334,17 @@ class TelegramNotifier:
     def stop(self):
         """Stop the notifier"""
         logger.info("Stopping Telegram Notifier...")
-        asyncio.run(self.send_message("🔴 Trap Monitor System Offline"))
         self.client.disconnect()
         self.client.loop_stop()
+        try:
+            self.notify('text', "🔴 Trap Monitor System Offline")
+            asyncio.run_coroutine_threadsafe(self.tx_queue.join(), self.loop).result(timeout=30)
+            self.loop.call_soon_threadsafe(self.sender_task.cancel)
+            asyncio.run_coroutine_threadsafe(self.bot.shutdown(), self.loop).result(timeout=10)
+        except Exception as e:
+            logger.error(f"Error shutting down Telegram bot: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
 
 def load_config():
     """Load configuration from YAML file"""